@@ -1,10 +1,13 @@
 from pathlib import Path
+import os
 import re
+from functools import lru_cache
 import pysam as ps
-import csv
 import subprocess as sp
+import shutil
+import mmap
 import numpy as np
-import random
+from itertools import islice, compress
 
 default_prefix = "octopus"
 default_germline_measures = "AC AD ADP AF AFB ARF BMQ BQ CC CRF DAD DAF DC DENOVO DP DPC ER ERS FRF GC GQ GQD ITV MC MF MHL MP MRC MQ MQ0 MQD PLN PP PPD QD QUAL REB RSB RTB SB SD SF STRL STRP VL".split()
@@ -74,6 +77,16 @@ for reference in ["GRCh37", "GRCh38"]:
     for sample, synonym in sample_synonyms.items():
         known_truth_set_urls["GIAB"][reference][synonym] = known_truth_set_urls["GIAB"][reference][sample]
 
+def parse_octopus_options(options):
+    result, flag = {}, None
+    for option in options:
+        if re.match(r'--?[A-Za-z]', option):
+            flag = option
+            result.setdefault(flag, [])
+        elif flag is not None and option:
+            result[flag].append(option)
+    return result
+
 class TrainingExample:
     def __init__(self, data):
         self.kind = data["kind"] if "kind" in data else "germline"
@@ -92,6 +105,7 @@ class TrainingExample:
         self.options = data["options"] if "options" in data else []
         if type(self.options) is str:
             self.options = self.options.split(' ')
+        self.option_values = parse_octopus_options(self.options)
 
 class ForestHyperparameters:
     def __init__(self, d):
@@ -107,6 +121,11 @@ class TrainingOptions:
 prefix = default_prefix
 measures = default_germline_measures
 
+@lru_cache(maxsize=None)
+def read_bam_sample(bam_filename):
+    with ps.AlignmentFile(str(bam_filename)) as bam:
+        return bam.header["RG"][0]["SM"]
+
 def load_config():
     outdir = config["dir"] if "dir" in config else ""
     global prefix
@@ -170,7 +189,7 @@ def load_config():
             else:
                 if not example.confident.exists():
                     raise ValueError(example.confident + " does not exist")
-            read_samples = [ps.AlignmentFile(example.reads[n]).header["RG"][0]["SM"] for n in range(len(example.reads))]
+            read_samples = [read_bam_sample(bam) for bam in example.reads]
             example.truth, example.confident = {sample: example.truth for sample in read_samples}, {sample: example.confident for sample in read_samples}
 
     return {example.name: example for example in examples}, TrainingOptions(config['training'] if "training" in config else None)
@@ -192,8 +211,8 @@ rule samtools_faidx:
 localrules: samtools_faidx
 
 def get_threads(example):
-    if "--threads" in example.options:
-        return int(example.options[example.options.index("--threads") + 1])
+    if "--threads" in example.option_values:
+        return int(example.option_values["--threads"][0])
     else:
         return 1
 
@@ -276,8 +295,9 @@ rule filter_somatics:
     output:
         vcf = "calls/{label}.octopus.ann.somatic.vcf.gz",
         vcf_index = "calls/{label}.octopus.ann.somatic.vcf.gz.tbi"
+    threads: lambda wildcards: examples[wildcards.label].threads
     shell:
-        "bcftools view -i FORMAT/SOMATIC[*]=1 -Oz -o {output.vcf} {input.vcf} && tabix {output.vcf}"
+        "bcftools view -i FORMAT/SOMATIC[*]=1 --threads {threads} --write-index=tbi -Oz -o {output.vcf} {input.vcf}"
 localrules: filter_somatics
 
 rule rtg_format:
@@ -297,21 +317,21 @@ rule download_giab:
         bed = "truth/{sample}.{reference}.GIAB.bed"
     params:
         vcf = lambda wildcards: known_truth_set_urls["GIAB"][wildcards.reference][wildcards.sample]["vcf"],
+        vcf_index = lambda wildcards: known_truth_set_urls["GIAB"][wildcards.reference][wildcards.sample]["vcf_idx"],
         bed = lambda wildcards: known_truth_set_urls["GIAB"][wildcards.reference][wildcards.sample]["bed"]
     shell:
         """
-        curl -o {output.vcf} {params.vcf}
-        curl -o {output.vcf_index} {params.vcf}.tbi
-        curl -o {output.bed} {params.bed}
+        curl --parallel \
+             -o {output.vcf} {params.vcf} \
+             -o {output.vcf_index} {params.vcf_index} \
+             -o {output.bed} {params.bed}
         """
 localrules: download_giab
 
 def get_vcfeval_ploidy_option(example, sample):
-    if "--organism-ploidy" in example.options:
-        ploidy_idx = example.options.index("--organism-ploidy")
-        if ploidy_idx >= 0:
-            ploidy = example.options[ploidy_idx + 1]
-            return "--sample-ploidy=" + str(ploidy)
+    if "--organism-ploidy" in example.option_values:
+        ploidy = example.option_values["--organism-ploidy"][0]
+        return "--sample-ploidy=" + str(ploidy)
     return ""
 
 rule vcfeval:
@@ -330,7 +350,7 @@ rule vcfeval:
         ploidy = lambda wildcards: get_vcfeval_ploidy_option(examples[wildcards.label], wildcards.sample),
         calls_sample = lambda wildcards: "ALT" if wildcards.kind == "somatic" else wildcards.sample,
         mode = "annotate"
-    threads: 20
+    threads: lambda wildcards: examples[wildcards.label].threads
     shell:
         "bcftools view -h {input.baseline_vcf} | \
          tail -1 | awk '{{if($NF==\"INFO\"){{print \"ALT\"}}else{{print $NF}}}}' | \
@@ -360,35 +380,35 @@ def has_homref_calls(vcf_filename, sample=None):
     if sample is None:
         assert len(vcf.header.samples) == 1
         sample = vcf.header.samples[0]
+    vcf.subset_samples([sample])
     for rec in vcf:
         if is_homref(rec, sample): return True
     return False
 
-def complement_vcf(src_vcf_filename, tagret_vcf_filenames, dst_vcf_filename, regions_bed=None):
-    cmd = ['bcftools', 'isec', '-C', str(src_vcf_filename)] + [str(f) for f in tagret_vcf_filenames] + ['-w1', '-Oz', '-o', str(dst_vcf_filename)]
+def complement_vcf(src_vcf_filename, tagret_vcf_filenames, dst_vcf_filename, regions_bed=None, threads=1):
+    cmd = ['bcftools', 'isec', '-C', str(src_vcf_filename)] + [str(f) for f in tagret_vcf_filenames] + ['-w1', '-Oz', '-o', str(dst_vcf_filename), '--threads', str(threads)]
     if regions_bed is not None:
         cmd += ["-R", regions_bed]
     sp.call(cmd)
-    index_vcf(dst_vcf_filename)
+    index_vcf(dst_vcf_filename, threads=threads)
 
-def intersect_vcfs(src_vcf_filenames, dst_vcf_filename, regions_bed=None):
-    cmd = ['bcftools', 'isec'] + [str(f) for f in src_vcf_filenames] + ['-n', str(len(src_vcf_filenames)), '-w1', '-Oz', '-o', str(dst_vcf_filename)]
+def intersect_vcfs(src_vcf_filenames, dst_vcf_filename, regions_bed=None, threads=1):
+    cmd = ['bcftools', 'isec'] + [str(f) for f in src_vcf_filenames] + ['-n', str(len(src_vcf_filenames)), '-w1', '-Oz', '-o', str(dst_vcf_filename), '--threads', str(threads)]
     if regions_bed is not None:
         cmd += ["-R", regions_bed]
     sp.call(cmd)
-    index_vcf(dst_vcf_filename)
+    index_vcf(dst_vcf_filename, threads=threads)
 
-def concat_vcfs(vcfs, out, remove_duplicates=True):
+def concat_vcfs(vcfs, out, remove_duplicates=True, threads=1):
     assert len(vcfs) > 1
-    cmd = ['bcftools', 'concat', '-a', '-Oz', '-o', str(out)]
+    cmd = ['bcftools', 'concat', '-a', '-Oz', '-o', str(out), '--threads', str(threads), '--write-index=tbi']
     if remove_duplicates:
         cmd.append('-D')
     cmd += [str(vcf) for vcf in vcfs]
     sp.call(cmd)
-    index_vcf(out)
 
-def index_vcf(vcf_filename):
-    sp.call(['tabix', '-f', str(vcf_filename)])
+def index_vcf(vcf_filename, threads=1):
+    sp.call(['bcftools', 'index', '-t', '-f', '--threads', str(threads), str(vcf_filename)])
 
 def remove_vcf_index(vcf_filename):
     vcf_index_filename = vcf_filename.with_suffix(vcf_filename.suffix + '.tbi')
@@ -410,8 +430,9 @@ def classify_vcfeval_ignored_calls(vcfeval_dir, octopus_vcf, sample, regions=Non
     calls_vcf = ps.VariantFile(vcfeval_dir / "calls.vcf.gz")
     baseline_vcf = ps.VariantFile(vcfeval_dir / "baseline.vcf.gz")
     new_calls_vcf = ps.VariantFile(vcfeval_dir / "calls.homref.vcf.gz", 'wz', header=calls_vcf.header)
+    baseline_contigs = set(baseline_vcf.header.contigs)
     for call in calls_vcf:
-        if call.info["CALL"] == "IGN" and call.contig in baseline_vcf.header.contigs:
+        if call.info["CALL"] == "IGN" and call.contig in baseline_contigs:
             if any(baseline.info["BASE"] == "FN" for baseline in baseline_vcf.fetch(call.contig, call.start, call.stop)):
                 call.info["CALL"] = "FP"
             else:
@@ -456,14 +477,32 @@ def get_annotation(field, rec, sample=None):
         # Field must be a flag and not present
         return 0
 
-def is_missing(x):
-    return x is None or x == '.' or np.isnan(float(x))
-
-def to_str(x):
-    return str(x) if type(x) != bool else str(int(x))
+def make_annotation_getter(field, header, sample=None):
+    if field == 'QUAL':
+        return lambda rec: rec.qual
+    in_format, in_info = field in header.formats, field in header.info
+    if in_format and in_info:
+        return lambda rec: get_annotation(field, rec, sample=sample)
+    elif in_format:
+        if sample is None:
+            assert len(header.samples) == 1
+            sample = header.samples[0]
+        def get_format_annotation(rec):
+            res = rec.samples[sample].get(field, 0)
+            return np.mean(res) if type(res) == tuple else res
+        return get_format_annotation
+    elif in_info:
+        def get_info_annotation(rec):
+            res = rec.info.get(field, 0)
+            return np.mean(res) if type(res) == tuple else res
+        return get_info_annotation
+    else:
+        # Field must be a flag and not present
+        return lambda rec: 0
 
-def annotation_to_string(x, missing_value):
-    return to_str(missing_value) if is_missing(x) else to_str(x)
+def annotation_to_float(x):
+    # NaN values pass through float() and are replaced with the missing value later
+    return np.nan if x is None or x == '.' else float(x)
 
 def encode_classification(classifcation):
     if classifcation == "TP":
@@ -473,16 +512,28 @@ def encode_classification(classifcation):
     else:
         return 2
 
-def make_ranger_data(vcf_filename, out_filename, sample, classifcation, measures, missing_value=-1, fraction=1):
+def make_ranger_data(vcf_filename, out_filename, sample, classifcation, measures, missing_value=-1, fraction=1, batch_size=1<<14):
     vcf = ps.VariantFile(vcf_filename)
-    with out_filename.open(mode='w') as ranger_data:
-        datawriter = csv.writer(ranger_data, delimiter=' ')
-        encoded_classification = encode_classification(classifcation)
-        for rec in vcf:
-            if rec.info["CALL"] == classifcation and (fraction >= 1 or random.random() <= fraction):
-                row = [annotation_to_string(get_annotation(measure, rec, sample=sample), missing_value) for measure in measures]
-                row.append(encoded_classification)
-                datawriter.writerow(row)
+    if sample is not None:
+        vcf.subset_samples([sample])
+    getters = [make_annotation_getter(measure, vcf.header, sample=sample) for measure in measures]
+    records = (rec for rec in vcf if rec.info["CALL"] == classifcation)
+    batch = np.empty((batch_size, len(getters) + 1), dtype=np.float32)
+    batch[:, -1] = encode_classification(classifcation)
+    with out_filename.open(mode='wb', buffering=1<<20) as ranger_data:
+        while True:
+            recs = list(islice(records, batch_size))
+            if not recs: break
+            if fraction < 1:
+                # Drop records before any annotations are extracted
+                recs = list(compress(recs, np.random.random(len(recs)) <= fraction))
+            n = len(recs)
+            values = (annotation_to_float(get(rec)) for rec in recs for get in getters)
+            features = batch[:n, :-1]
+            features[:] = np.fromiter(values, dtype=np.float32, count=n * len(getters)).reshape(n, len(getters))
+            features[np.isnan(features)] = missing_value
+            np.savetxt(ranger_data, batch[:n], fmt='%.5g', delimiter=' ')
+    vcf.close()
 
 rule extract_annotations:
     input:
@@ -514,40 +565,71 @@ rule cat_annotations:
 localrules: cat_annotations
 
 def get_sample_kind(example, sample):
-    if example.kind == "somatic" and "--normal-samples" in example.options:
-        normal_sample_idx = example.options.index("--normal-samples")
-        if example.options[normal_sample_idx + 1] == sample:
+    if example.kind == "somatic" and "--normal-samples" in example.option_values:
+        if example.option_values["--normal-samples"][0] == sample:
             return "germline"
     return example.kind
 
-rule cat_data:
+def find_line_ends(data, chunk_size=1<<26):
+    ends = [np.flatnonzero(data[offset:offset + chunk_size] == ord('\n')) + (offset + 1) \
+            for offset in range(0, len(data), chunk_size)]
+    if len(data) > 0 and data[-1] != ord('\n'):
+        ends.append(np.array([len(data)]))
+    return np.concatenate(ends) if ends else np.empty(0, dtype=np.int64)
+
+def sample_lines(in_filename, out_file, fraction):
+    if in_filename.stat().st_size == 0: return
+    with in_filename.open(mode='rb') as in_file, mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        data = np.frombuffer(buf, dtype=np.uint8)
+        try:
+            ends = find_line_ends(data)
+        finally:
+            # The mapping cannot be closed while a NumPy view of it is alive
+            del data
+        starts = np.r_[0, ends[:-1]]
+        keep = np.random.random(len(ends)) <= fraction
+        # Write each run of consecutive kept lines as a single slice
+        edges = np.flatnonzero(np.diff(np.r_[False, keep, False]))
+        for first, last in zip(edges[::2], edges[1::2]):
+            out_file.write(buf[int(starts[first]):int(ends[last - 1])])
+
+def append_file(in_filename, out_file):
+    with in_filename.open(mode='rb') as in_file:
+        offset = 0
+        if hasattr(os, 'sendfile'):
+            out_file.flush()
+            size = os.fstat(in_file.fileno()).st_size
+            try:
+                while offset < size:
+                    sent = os.sendfile(out_file.fileno(), in_file.fileno(), offset, size - offset)
+                    if sent == 0: break
+                    offset += sent
+            except OSError:
+                pass  # fall back to a buffered copy of whatever is left
+        in_file.seek(offset)
+        shutil.copyfileobj(in_file, out_file, 1<<20)
+
+def make_ranger_master_data_file(in_filenames, out_filename, header, sample=None):
+    with out_filename.open(mode='wb', buffering=1<<20) as out_file:
+        out_file.write((header + '\n').encode())
+        for in_filename in in_filenames:
+            if sample is None:
+                append_file(in_filename, out_file)
+            else:
+                sample_lines(in_filename, out_file, sample)
+
+rule make_ranger_data:
     input:
         ["dat/" + example.name + ".octopus.ann." + sample + "." + get_sample_kind(example, sample) + ".dat" \
          for _, example in examples.items() \
          for sample, _ in example.truth.items()]
-    output:
-        "dat/" + prefix + ".full.dat"
-    shell:
-        "cat {input} > {output}"
-localrules: cat_data
-
-def make_ranger_master_data_file(in_filename, out_filename, header, sample=None):
-    with in_filename.open() as in_file, out_filename.open(mode='w') as out_file:
-        out_file.write(header + '\n')
-        for line in in_file:
-            if sample is None or random.random() <= sample:
-                out_file.write(line)
-
-rule make_ranger_data:
-    input:
-        rules.cat_data.output
     output:
         "dat/" + prefix + ".training.dat"
     params:
         header = " ".join(measures + ['TP']),
         training_fraction = options.training_fraction
     run:
-        make_ranger_master_data_file(Path(input[0]), Path(output[0]), params.header, sample=params.training_fraction)
+        make_ranger_master_data_file([Path(f) for f in input], Path(output[0]), params.header, sample=params.training_fraction)
 localrules: make_ranger_data
 
 rule install_ranger: